@@ -1,30 +1,135 @@
 from flask import Flask, request, jsonify
-import joblib, json, pandas as pd, os
+from flask.json.provider import JSONProvider
+import orjson
+import msgspec
+import json, numpy as np, os, csv, sqlite3, threading, math, queue, hmac
 from datetime import datetime
-from geopy.distance import geodesic
-from xgboost import XGBRegressor
-from sklearn.preprocessing import LabelEncoder
+from functools import lru_cache
+from typing import Annotated, Optional
+from numba import njit
+
+
+class OrjsonProvider(JSONProvider):
+    """Route Flask's JSON responses (jsonify) through orjson."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS | orjson.OPT_SERIALIZE_NUMPY).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(
+            orjson.dumps(obj, option=orjson.OPT_SORT_KEYS | orjson.OPT_SERIALIZE_NUMPY),
+            mimetype="application/json",
+        )
+
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 BASE_LOCATION = (-1.263757, 36.9116907)  # Shop base
+EARTH_RADIUS_KM = 6371.0088
+# Shop trig terms, shared by the scalar and vectorized haversine
+BASE_LAT_RAD = math.radians(BASE_LOCATION[0])
+BASE_LON_RAD = math.radians(BASE_LOCATION[1])
+BASE_COS = math.cos(BASE_LAT_RAD)
+
+# Nairobi tiers: base fee covers the first 1.8 km; ETA steps at 1.8 km and 5 km
+NAIROBI_LABELS = frozenset({"nairobi", "nairobi county", "nbi"})
+NAIROBI_BASE_KM = 1.8
+NAIROBI_THRESHOLDS = np.array([NAIROBI_BASE_KM, 5.0])
+NAIROBI_ETAS = np.array([0.5, 1.0, 1.5])
+OTHER_ETA_HOURS = 6.0
 MODEL_FILE = "xgb_delivery_model.json"
-ENCODER_FILE = "city_encoder.pkl"
+ENCODER_FILE = "county_encoder.json"  # {county: index}, written at training time
 CONFIG_FILE = "config.json"
-DATA_FILE = "delivery_history.csv"
+DATA_FILE = "delivery_history.db"
+LEGACY_DATA_FILE = "delivery_history.csv"  # imported once when the DB is created
+DATA_COLUMNS = [
+    "timestamp","latitude","longitude","county",
+    "distance_km","predicted_price_ksh","predicted_eta_hours"
+]
 
 API_KEY = os.getenv("FLASK_API_KEY", "b20f69591f2e4c906777e888437bb690")
+API_KEY_BYTES = API_KEY.encode()
 
 # Load AI model & encoder if available
-model, encoder = None, None
+booster = None
+CLASS_MAP = {}
 if os.path.exists(MODEL_FILE) and os.path.exists(ENCODER_FILE):
-    model = XGBRegressor()
-    model.load_model(MODEL_FILE)
-    encoder = joblib.load(ENCODER_FILE)
+    # Heavy ML import only when a model is actually deployed
+    import xgboost
+
+    booster = xgboost.Booster()
+    booster.load_model(MODEL_FILE)
+    with open(ENCODER_FILE) as f:
+        CLASS_MAP = json.load(f)
     print("✅ Loaded AI model and encoder.")
+elif os.path.exists(MODEL_FILE):
+    print(f"⚠️ {MODEL_FILE} found but {ENCODER_FILE} is missing, using rule-based fallback. "
+          f"Re-export the encoder at training time with "
+          f"json.dump({{c: int(i) for i, c in enumerate(le.classes_)}}, open(\"{ENCODER_FILE}\", \"w\")).")
 else:
     print("⚠️ AI model not found, using rule-based fallback.")
 
+# Micro-batching: requests that queue up while a prediction is running
+# share the next inplace_predict call. Only worth it when a worker serves
+# several requests at once (GUNICORN_THREADS > 1, see gunicorn.conf.py).
+BATCH_PREDICT = int(os.getenv("GUNICORN_THREADS", "1")) > 1
+MAX_BATCH = 64
+predict_queue = queue.Queue()
+predictor_lock = threading.Lock()
+predictor_thread = None
+warming_up = True  # _warmup predicts inline so the preloading master stays single-threaded
+
+
+def predictor_loop():
+    while True:
+        batch = [predict_queue.get()]
+        # Take only rows already waiting; never hold a lone request back
+        while len(batch) < MAX_BATCH:
+            try:
+                batch.append(predict_queue.get_nowait())
+            except queue.Empty:
+                break
+
+        try:
+            preds = booster.inplace_predict(np.vstack([item[0] for item in batch]))
+        except Exception as e:
+            for _, event, result in batch:
+                result["error"] = e
+                event.set()
+            continue
+
+        for (_, event, result), pred in zip(batch, preds):
+            result["value"] = float(pred)
+            event.set()
+
+
+def predict_price(features):
+    """Price one (1, 4) feature row, via the batch predictor when batching is on."""
+    global predictor_thread
+    if not BATCH_PREDICT or warming_up:
+        return float(booster.inplace_predict(features)[0])
+
+    # Started lazily, in the worker that serves the request, never before fork
+    if predictor_thread is None:
+        with predictor_lock:
+            if predictor_thread is None:
+                predictor_thread = threading.Thread(target=predictor_loop, daemon=True)
+                predictor_thread.start()
+
+    event, result = threading.Event(), {}
+    predict_queue.put((features, event, result))
+    event.wait()
+    if "error" in result:
+        # The exception is shared by every waiter in the batch; chain, don't re-raise it
+        raise RuntimeError("prediction failed") from result["error"]
+    return result["value"]
+
+
 # Load fallback config
 if os.path.exists(CONFIG_FILE):
     with open(CONFIG_FILE) as f:
@@ -39,12 +144,230 @@ else:
         "zone_surcharge": 10
     }
 
-# Ensure delivery_history.csv exists
-if not os.path.exists(DATA_FILE):
-    pd.DataFrame(columns=[
-        "timestamp","latitude","longitude","county",
-        "distance_km","predicted_price_ksh","predicted_eta_hours"
-    ]).to_csv(DATA_FILE, index=False)
+# Bind config values once; the handlers read these instead of the dict
+MIN_ORDER = config["min_delivery_order"]
+BASE_FEE_NBO = config["base_fee_nairobi"]
+RATE_KM_NBO = config["rate_per_km_nairobi"]
+FLAT_OTHERS = config["flat_rate_others"]
+FREE_SHIP_MIN = config["free_shipping_minimum"]
+ZONE_SUR = config["zone_surcharge"]
+
+# Delivery history lives in SQLite (WAL) so workers can insert concurrently
+log_lock = threading.Lock()
+db = None
+
+
+def get_db():
+    """Lazily opened connection; close_db drops it before any fork."""
+    global db
+    if db is None:
+        db = sqlite3.connect(DATA_FILE, check_same_thread=False, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            created = db.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'history'"
+            ).fetchone() is None
+            db.execute("""CREATE TABLE IF NOT EXISTS history (
+                timestamp TEXT, latitude REAL, longitude REAL, county TEXT,
+                distance_km REAL, predicted_price_ksh REAL, predicted_eta_hours REAL
+            )""")
+            if created:
+                import_legacy_history(db)
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+    return db
+
+
+def import_legacy_history(con):
+    """Copy rows from the old delivery_history.csv into a freshly created table."""
+    if not os.path.exists(LEGACY_DATA_FILE):
+        return
+    with open(LEGACY_DATA_FILE, newline="") as f:
+        rows = [[row.get(c) or None for c in DATA_COLUMNS] for row in csv.DictReader(f)]
+    con.executemany("INSERT INTO history VALUES (?,?,?,?,?,?,?)", rows)
+    print(f"✅ Imported {len(rows)} rows from {LEGACY_DATA_FILE}.")
+
+
+def close_db():
+    global db
+    with log_lock:
+        if db is not None:
+            db.close()
+            db = None
+
+
+# SQLite handles must not cross fork(): close ours before any fork and
+# let each worker open its own on first use
+os.register_at_fork(before=close_db)
+
+
+# Ensure the history table exists
+get_db()
+
+
+@njit(cache=True, fastmath=True)
+def haversine_km(lat, lon):
+    """Great-circle km from the shop (within ~0.5% of geodesic, plenty for shipping)."""
+    phi = math.radians(lat)
+    a = (math.sin((phi - BASE_LAT_RAD) / 2) ** 2
+         + BASE_COS * math.cos(phi) * math.sin((math.radians(lon) - BASE_LON_RAD) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+def haversine_km_vec(lats, lons):
+    """Distances in km from the shop to many destinations in one NumPy pass."""
+    phi = np.radians(lats)
+    a = (np.sin((phi - BASE_LAT_RAD) / 2) ** 2
+         + BASE_COS * np.cos(phi) * np.sin((np.radians(lons) - BASE_LON_RAD) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+# Compile now so the first request doesn't pay the JIT cost
+haversine_km(BASE_LOCATION[0], BASE_LOCATION[1])
+
+
+@lru_cache(maxsize=8192)
+def _distance_km(lat, lon):
+    return haversine_km(lat, lon)
+
+
+def distance_from_base(lat, lon):
+    """Distance in km from the shop, cached on coordinates rounded to ~10 m."""
+    return _distance_km(round(lat, 4), round(lon, 4))
+
+
+def log_entry(entry):
+    """Insert a single row into the delivery history."""
+    log_entries([entry])
+
+
+def log_entries(entries):
+    """Insert several rows into the delivery history in one transaction."""
+    with log_lock:
+        con = get_db()
+        # Autocommit would otherwise commit (and sync) once per row
+        con.execute("BEGIN")
+        try:
+            con.executemany(
+                "INSERT INTO history VALUES (?,?,?,?,?,?,?)",
+                [[entry[c] for c in DATA_COLUMNS] for entry in entries],
+            )
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+        con.execute("COMMIT")
+
+
+def history_entry(timestamp, lat, lon, county, distance_km, price=None, eta_hours=None):
+    return {
+        "timestamp": timestamp.isoformat(),
+        "latitude": lat,
+        "longitude": lon,
+        "county": county,
+        "distance_km": round(distance_km,2),
+        "predicted_price_ksh": None if price is None else round(price,2),
+        "predicted_eta_hours": eta_hours
+    }
+
+
+def min_order_error(order_total):
+    """400 response for orders below the delivery minimum, else None."""
+    if order_total < MIN_ORDER:
+        return jsonify({
+            "error": f"Minimum order for delivery is KSh {MIN_ORDER}",
+            "eligible": False
+        }), 400
+    return None
+
+
+def rule_based_price(county, distance_km, order_total):
+    """Fallback pricing when no AI model is deployed."""
+    if order_total >= FREE_SHIP_MIN:
+        return 0
+    if county.lower() in NAIROBI_LABELS:
+        if distance_km <= NAIROBI_BASE_KM:
+            return BASE_FEE_NBO
+        extra_distance = distance_km - NAIROBI_BASE_KM
+        return BASE_FEE_NBO + (RATE_KM_NBO * extra_distance)
+    return FLAT_OTHERS + ZONE_SUR
+
+
+# Request schemas, decoded and validated in one pass by msgspec
+Latitude = Annotated[float, msgspec.Meta(ge=-90, le=90)]
+Longitude = Annotated[float, msgspec.Meta(ge=-180, le=180)]
+OrderTotal = Annotated[float, msgspec.Meta(ge=0)]
+
+
+class Destination(msgspec.Struct):
+    latitude: Latitude = 0
+    longitude: Longitude = 0
+    billing_address_2: str = "Unknown"
+
+
+class PredictRateRequest(Destination):
+    order_total: OrderTotal = 0
+    timestamp: Optional[str] = None
+
+
+MAX_BATCH_DESTINATIONS = 1000
+
+
+class PredictRateBatchRequest(msgspec.Struct):
+    destinations: Annotated[list[Destination], msgspec.Meta(max_length=MAX_BATCH_DESTINATIONS)]
+    order_total: OrderTotal = 0
+    timestamp: Optional[str] = None
+
+
+class PredictEtaRequest(Destination):
+    timestamp: Optional[str] = None
+
+
+def decode_body(schema):
+    # strict=False keeps accepting numbers sent as strings, as float() did
+    return msgspec.json.decode(request.get_data(), type=schema, strict=False)
+
+
+class InvalidInput(ValueError):
+    pass
+
+
+def parse_timestamp(ts_str):
+    """ISO 8601 timestamp (date-only and 'Z' included); missing or empty means now.
+
+    Non-ISO forms that pd.to_datetime used to guess (e.g. "2024/01/01 10:00")
+    are rejected with a 400.
+    """
+    if not ts_str:
+        return datetime.now()
+    # fromisoformat only understands a trailing "Z" from Python 3.11 on
+    if ts_str.endswith(("Z", "z")):
+        ts_str = ts_str[:-1] + "+00:00"
+    try:
+        return datetime.fromisoformat(ts_str)
+    except ValueError as e:
+        raise InvalidInput(e) from e
+
+
+@app.errorhandler(InvalidInput)
+@app.errorhandler(msgspec.MsgspecError)
+def invalid_input(e):
+    return jsonify({"error": f"Invalid input: {e}"}), 400
+
+
+PUBLIC_ENDPOINTS = {"home", "static"}
+
+
+@app.before_request
+def require_api_key():
+    # endpoint is None for unknown URLs; let routing return its 404
+    if request.endpoint is None or request.endpoint in PUBLIC_ENDPOINTS:
+        return None
+    client_key = request.headers.get("X-API-Key", "").encode()
+    if not hmac.compare_digest(client_key, API_KEY_BYTES):
+        return jsonify({"error": "Unauthorized"}), 401
 
 
 @app.route("/")
@@ -52,71 +375,42 @@ def home():
     return jsonify({"message": "Nima Smart Shipping API active"})
 
 
-@app.route("/predict-rate", methods=["POST"])
+@app.route("/predict-rate", methods=["POST"], strict_slashes=False)
 def predict_rate():
-    client_key = request.headers.get("X-API-Key")
-    if client_key != API_KEY:
-        return jsonify({"error": "Unauthorized"}), 401
-
-    data = request.get_json()
-    try:
-        user_lat = float(data.get("latitude", 0))
-        user_lon = float(data.get("longitude", 0))
-        county = data.get("billing_address_2", "Unknown").strip()
-        order_total = float(data.get("order_total", 0))
-        timestamp = pd.to_datetime(data.get("timestamp", datetime.now().isoformat()))
-    except Exception as e:
-        return jsonify({"error": f"Invalid input: {e}"}), 400
+    body = decode_body(PredictRateRequest)
+    user_lat = body.latitude
+    user_lon = body.longitude
+    county = body.billing_address_2.strip()
+    order_total = body.order_total
+    timestamp = parse_timestamp(body.timestamp)
 
-    distance_km = geodesic(BASE_LOCATION, (user_lat, user_lon)).km
+    distance_km = distance_from_base(user_lat, user_lon)
 
     # Minimum order check
-    if order_total < config["min_delivery_order"]:
-        return jsonify({
-            "error": f"Minimum order for delivery is KSh {config['min_delivery_order']}",
-            "eligible": False
-        }), 400
+    error = min_order_error(order_total)
+    if error:
+        return error
 
     # AI prediction if model exists
-    if model and encoder:
+    if booster is not None:
         hour = timestamp.hour
-        dayofweek = timestamp.dayofweek
-        city_encoded = encoder.transform([county])[0] if county in encoder.classes_ else 0
-        X_pred = pd.DataFrame([[distance_km, city_encoded, hour, dayofweek]],
-                              columns=["distance_km", "city_encoded", "hour", "dayofweek"])
-        predicted_price = model.predict(X_pred)[0]
+        dayofweek = timestamp.weekday()
+        city_encoded = CLASS_MAP.get(county, 0)
+        # Feature order: distance_km, city_encoded, hour, dayofweek
+        X_pred = np.empty((1, 4), dtype=np.float32)
+        X_pred[0, 0] = distance_km
+        X_pred[0, 1] = city_encoded
+        X_pred[0, 2] = hour
+        X_pred[0, 3] = dayofweek
+        predicted_price = predict_price(X_pred)
         mode = "AI model"
     else:
         # Fallback rule-based
-        if "nairobi" in county.lower():
-            if order_total >= config["free_shipping_minimum"]:
-                predicted_price = 0
-            else:
-                if distance_km <= 1.8:
-                    predicted_price = config["base_fee_nairobi"]
-                else:
-                    extra_distance = distance_km - 1.8
-                    predicted_price = config["base_fee_nairobi"] + (config["rate_per_km_nairobi"] * extra_distance)
-        else:
-            if order_total >= config["free_shipping_minimum"]:
-                predicted_price = 0
-            else:
-                predicted_price = config["flat_rate_others"] + config["zone_surcharge"]
+        predicted_price = rule_based_price(county, distance_km, order_total)
         mode = "rule-based"
 
     # Log prediction
-    entry = {
-        "timestamp": timestamp.isoformat(),
-        "latitude": user_lat,
-        "longitude": user_lon,
-        "county": county,
-        "distance_km": round(distance_km,2),
-        "predicted_price_ksh": round(predicted_price,2),
-        "predicted_eta_hours": None
-    }
-    df = pd.read_csv(DATA_FILE)
-    df = pd.concat([df, pd.DataFrame([entry])], ignore_index=True)
-    df.to_csv(DATA_FILE, index=False)
+    log_entry(history_entry(timestamp, user_lat, user_lon, county, distance_km, price=predicted_price))
 
     return jsonify({
         "distance_km": round(distance_km,2),
@@ -125,42 +419,72 @@ def predict_rate():
     })
 
 
-@app.route("/predict-eta", methods=["POST"])
+@app.route("/predict-rate-batch", methods=["POST"], strict_slashes=False)
+def predict_rate_batch():
+    body = decode_body(PredictRateBatchRequest)
+    destinations = body.destinations
+    counties = [d.billing_address_2.strip() for d in destinations]
+    order_total = body.order_total
+    timestamp = parse_timestamp(body.timestamp)
+
+    # Minimum order check
+    error = min_order_error(order_total)
+    if error:
+        return error
+
+    # Same ~10 m rounding as distance_from_base, so results match /predict-rate
+    distances = haversine_km_vec(
+        np.array([round(d.latitude, 4) for d in destinations], dtype=np.float64),
+        np.array([round(d.longitude, 4) for d in destinations], dtype=np.float64),
+    ).tolist()
+
+    # AI prediction if model exists, one inplace_predict for the whole batch
+    if booster is not None:
+        X_pred = np.empty((len(destinations), 4), dtype=np.float32)
+        X_pred[:, 0] = distances
+        X_pred[:, 1] = [CLASS_MAP.get(c, 0) for c in counties]
+        X_pred[:, 2] = timestamp.hour
+        X_pred[:, 3] = timestamp.weekday()
+        prices = booster.inplace_predict(X_pred).tolist()
+        mode = "AI model"
+    else:
+        # Fallback rule-based
+        prices = [rule_based_price(c, d, order_total) for c, d in zip(counties, distances)]
+        mode = "rule-based"
+
+    # Log predictions
+    log_entries([
+        history_entry(timestamp, d.latitude, d.longitude, county, distance_km, price=price)
+        for d, county, distance_km, price in zip(destinations, counties, distances, prices)
+    ])
+
+    return jsonify({
+        "results": [
+            {"distance_km": round(distance_km,2), "predicted_price_ksh": round(price,2)}
+            for distance_km, price in zip(distances, prices)
+        ],
+        "mode": mode
+    })
+
+
+@app.route("/predict-eta", methods=["POST"], strict_slashes=False)
 def predict_eta():
-    data = request.get_json()
-    try:
-        user_lat = float(data.get("latitude", 0))
-        user_lon = float(data.get("longitude", 0))
-        county = data.get("billing_address_2", "Unknown").strip()
-        timestamp = pd.to_datetime(data.get("timestamp", datetime.now().isoformat()))
-    except Exception as e:
-        return jsonify({"error": f"Invalid input: {e}"}), 400
+    body = decode_body(PredictEtaRequest)
+    user_lat = body.latitude
+    user_lon = body.longitude
+    county = body.billing_address_2.strip()
+    timestamp = parse_timestamp(body.timestamp)
 
-    distance_km = geodesic(BASE_LOCATION, (user_lat, user_lon)).km
+    distance_km = distance_from_base(user_lat, user_lon)
 
     # ETA logic
-    if "nairobi" in county.lower():
-        if distance_km <= 1.8:
-            eta_hours = 0.5
-        elif distance_km <= 5:
-            eta_hours = 1.0
-        else:
-            eta_hours = 1.5
+    is_nairobi = county.lower() in NAIROBI_LABELS
+    if is_nairobi:
+        eta_hours = float(NAIROBI_ETAS[np.searchsorted(NAIROBI_THRESHOLDS, distance_km)])
     else:
-        eta_hours = 6.0
+        eta_hours = OTHER_ETA_HOURS
 
-    entry = {
-        "timestamp": timestamp.isoformat(),
-        "latitude": user_lat,
-        "longitude": user_lon,
-        "county": county,
-        "distance_km": round(distance_km,2),
-        "predicted_price_ksh": None,
-        "predicted_eta_hours": eta_hours
-    }
-    df = pd.read_csv(DATA_FILE)
-    df = pd.concat([df, pd.DataFrame([entry])], ignore_index=True)
-    df.to_csv(DATA_FILE, index=False)
+    log_entry(history_entry(timestamp, user_lat, user_lon, county, distance_km, eta_hours=eta_hours))
 
     return jsonify({
         "predicted_eta_hours": round(eta_hours,2),
@@ -169,5 +493,45 @@ def predict_eta():
     })
 
 
+WARMUP_COUNTY = "__warmup__"
+
+
+def _warmup():
+    """Run one synthetic /predict-rate through the full pipeline at boot.
+
+    Loads the JIT cache, runs the model, creates the history table and
+    exercises JSON encoding, so the first real request doesn't pay for it.
+    With preload_app the forked workers inherit it; the DB handle is closed
+    and the model is called inline (no predictor thread) so neither crosses
+    the fork.
+    """
+    payload = {
+        "latitude": BASE_LOCATION[0],
+        "longitude": BASE_LOCATION[1],
+        "billing_address_2": WARMUP_COUNTY,
+        "order_total": MIN_ORDER,
+    }
+    global warming_up
+    try:
+        with app.test_client() as client:
+            resp = client.post("/predict-rate", data=orjson.dumps(payload),
+                               headers={"X-API-Key": API_KEY}, content_type="application/json")
+        with log_lock:
+            get_db().execute("DELETE FROM history WHERE county = ?", (WARMUP_COUNTY,))
+    finally:
+        close_db()
+        warming_up = False
+    # The test client turns exceptions into a 500; don't boot with a broken pipeline
+    if resp.status_code != 200:
+        raise RuntimeError(f"Warmup /predict-rate failed ({resp.status_code}): {resp.get_data(as_text=True)}")
+
+
+_warmup()
+
+
 if __name__ == "__main__":
-    app.run(debug=False)
+    # Local development only; production runs under gunicorn (see gunicorn.conf.py)
+    if os.getenv("FLASK_DEV") == "1":
+        app.run(debug=False)
+    else:
+        print("Run with: gunicorn -c gunicorn.conf.py app:app (or set FLASK_DEV=1)")
@@ -0,0 +1,14 @@
+# Production launch: gunicorn -c gunicorn.conf.py app:app
+import os
+
+# Inference is a tiny slice of request latency, so scale with processes,
+# one thread each, and keep XGBoost from oversubscribing cores across workers.
+os.environ.setdefault("OMP_NUM_THREADS", "1")
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+workers = int(os.getenv("WEB_CONCURRENCY", (os.cpu_count() or 1) * 2))
+threads = int(os.getenv("GUNICORN_THREADS", "1"))
+worker_class = "sync"
+
+# Import (and warm up) the app once in the master; workers inherit it on fork
+preload_app = True